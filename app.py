@@ -1,9 +1,12 @@
+import hashlib
+import os
 import re
-import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 import pandas as pd
 import streamlit as st
+from lxml import etree as ET
 
 # ---------------------------------------------------------
 # CONFIGURAÇÃO BÁSICA DA PÁGINA
@@ -30,68 +33,147 @@ Aplicação para **analisar XMLs de Currículos Lattes** gerados pelo Lattes Ext
 # FUNÇÕES AUXILIARES
 # ---------------------------------------------------------
 
+# Caracteres de controle inválidos no XML 1.0: 0x00–0x08, 0x0B, 0x0C, 0x0E–0x1F
+# (bytes a remover com bytes.translate; não ocorrem dentro de sequências UTF-8/Latin-1)
+_CTRL_BYTES = bytes([*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20)])
+# & que não fazem parte de entidades (&amp;, &lt;, &#123;, etc)
+_AMP_RE = re.compile(rb"&(?!#?\w+;)")
+
+# Níveis de formação (filhos de FORMACAO-ACADEMICA-TITULACAO), na ordem de exibição
+_NIVEIS = (
+    "GRADUACAO",
+    "ESPECIALIZACAO",
+    "MESTRADO",
+    "MESTRADO-PROFISSIONALIZANTE",
+    "DOUTORADO",
+    "POS-DOUTORADO",
+    "LIVRE-DOCENCIA",
+    "RESIDENCIA-MEDICA",
+    "APERFEICOAMENTO",
+    "CURSO-TECNICO-PROFISSIONALIZANTE",
+    "ENSINO-FUNDAMENTAL-PRIMEIRO-GRAU",
+    "ENSINO-MEDIO-SEGUNDO-GRAU",
+)
+_NIVEIS_ORDER = {nivel: i for i, nivel in enumerate(_NIVEIS)}
+# Filhos cujo nome local (sem namespace) é um dos níveis; filtro feito em C pelo libxml2
+_NIVEIS_XP = ET.XPath("*[" + " or ".join(f"local-name()='{nivel}'" for nivel in _NIVEIS) + "]")
+
 
-def limpar_xml_bruto(content_bytes: bytes) -> str:
+def limpar_xml_bruto(content_bytes: bytes) -> bytes:
     """
-    Limpa e normaliza o conteúdo XML:
-    - tenta decodificar em UTF-8, se falhar usa Latin-1 (ignorando erros);
+    Limpa o conteúdo XML bruto, sem decodificá-lo (a decodificação fica a cargo
+    do parser, conforme o encoding declarado no XML):
     - remove caracteres de controle proibidos em XML 1.0;
     - escapa & que não fizerem parte de entidades (&amp;, &lt;, etc).
     """
-    # 1) Decodificação com fallback
-    try:
-        text = content_bytes.decode("utf-8")
-    except UnicodeDecodeError:
-        text = content_bytes.decode("latin-1", errors="ignore")
+    # 1) Remover caracteres de controle inválidos no XML 1.0
+    content_bytes = content_bytes.translate(None, _CTRL_BYTES)
 
-    # 2) Remover caracteres de controle inválidos no XML 1.0
-    #    Faixas: 0x00–0x08, 0x0B, 0x0C, 0x0E–0x1F
-    text = re.sub(r"[\x00-\x08\x0B\x0C\x0E-\x1F]", "", text)
-
-    # 3) Escapar & que não sejam entidades
+    # 2) Escapar & que não sejam entidades
     #    Ex: "P&D & Inovação" -> "P&amp;D &amp; Inovação"
-    text = re.sub(r"&(?!#?\w+;)", "&amp;", text)
+    if b"&" in content_bytes:
+        content_bytes = _AMP_RE.sub(b"&amp;", content_bytes)
+
+    return content_bytes
 
-    return text
 
+def _local(tag: str) -> str:
+    """Nome local da tag, sem namespace: "{ns}DADOS-GERAIS" -> "DADOS-GERAIS"."""
+    return tag.rpartition("}")[2]
 
-def parse_curriculo(file_obj):
+
+def _iterparse_xml(xml_bytes: bytes, events, recover: bool = True):
+    """
+    Cria um iterparse (lxml) sobre o XML, sem montar a árvore inteira.
+    Com recover=False qualquer erro de sintaxe gera XMLSyntaxError.
+    O modo tolerante só é usado depois que o parse estrito falhou; nele, bytes
+    que não são UTF-8 válido são lidos como ISO-8859-1 (mesmo que o XML declare UTF-8).
+    """
+    encoding = None
+    if recover:
+        try:
+            xml_bytes.decode("utf-8")
+        except UnicodeDecodeError:
+            encoding = "ISO-8859-1"
+
+    # Uploads não são confiáveis: sem expansão de entidades (billion laughs),
+    # sem acesso à rede (XXE) e com os limites padrão do libxml2 (huge_tree=False)
+    return ET.iterparse(
+        BytesIO(xml_bytes),
+        events=events,
+        recover=recover,
+        encoding=encoding,
+        resolve_entities=False,
+        no_network=True,
+        huge_tree=False,
+    )
+
+
+def _ler_inicio_curriculo(xml_bytes: bytes, recover: bool):
+    """
+    Lê o XML só até o início de DADOS-GERAIS.
+    Retorna (raiz, atributos de DADOS-GERAIS ou None).
+    """
+    root = None
+    for _, elem in _iterparse_xml(xml_bytes, events=("start",), recover=recover):
+        if root is None:
+            root = elem
+            continue
+        # No evento "start" os atributos já estão completos: não é preciso
+        # ler o restante do documento para montar o resumo
+        if elem.getparent() is root and _local(elem.tag) == "DADOS-GERAIS":
+            return root, dict(elem.attrib)
+    return root, None
+
+
+@st.cache_data(show_spinner=False)
+def parse_curriculo(nome_arquivo: str, content_bytes: bytes):
     """
     Faz o parse robusto de um XML Lattes (CURRICULO-VITAE):
     - Limpa conteúdo bruto;
     - Trata namespaces;
     - Extrai dados gerais básicos para resumo.
+    Lê o XML só até o início de DADOS-GERAIS e devolve os bytes usados no parse,
+    para que a formação seja extraída apenas quando o currículo for selecionado.
+    O resultado fica em cache pelo conteúdo do arquivo, evitando reprocessar
+    o mesmo XML a cada rerun do Streamlit.
+    Não chama st.* (pode rodar em threads auxiliares): erros e alertas vêm em
+    `avisos`, lista de (nível, mensagem) com nível "error" ou "warning".
     """
-    content_bytes = file_obj.read()
-
-    # Limpar e normalizar XML
-    xml_str = limpar_xml_bruto(content_bytes)
-
+    avisos = []
     try:
-        root = ET.fromstring(xml_str)
-    except ET.ParseError as e:
-        st.error(f"Erro ao parsear XML {file_obj.name}: {e}")
-        return None, None
+        # A maioria dos XMLs do Lattes Extrator já é válida: tentamos direto nos
+        # bytes originais e só limpamos/normalizamos quando o parse estrito falha
+        xml_bytes = content_bytes
+        try:
+            root, dados_gerais = _ler_inicio_curriculo(xml_bytes, recover=False)
+        except ET.XMLSyntaxError:
+            xml_bytes = limpar_xml_bruto(content_bytes)
+            root, dados_gerais = _ler_inicio_curriculo(xml_bytes, recover=True)
+    except ET.XMLSyntaxError as e:
+        avisos.append(("error", f"Erro ao parsear XML {nome_arquivo}: {e}"))
+        return None, None, avisos
+
+    # Com recover=True o libxml2 pode não conseguir montar nenhuma raiz
+    if root is None:
+        avisos.append(("error", f"Erro ao parsear XML {nome_arquivo}: documento vazio ou irrecuperável."))
+        return None, None, avisos
 
     # Tag raiz pode vir com namespace: {ns}CURRICULO-VITAE
-    tag_root = root.tag.split("}")[-1]
+    tag_root = _local(root.tag)
     if tag_root != "CURRICULO-VITAE":
-        st.warning(
-            f"Arquivo {file_obj.name} não parece ter raiz 'CURRICULO-VITAE' (tag encontrada: {tag_root})."
+        avisos.append(
+            (
+                "warning",
+                f"Arquivo {nome_arquivo} não parece ter raiz 'CURRICULO-VITAE' (tag encontrada: {tag_root}).",
+            )
         )
 
     # ID Lattes
     id_lattes = root.attrib.get("NUMERO-IDENTIFICADOR", "")
 
-    # Localizar DADOS-GERAIS, com ou sem namespace
-    dados_gerais = None
-    for child in root:
-        if child.tag.endswith("DADOS-GERAIS"):
-            dados_gerais = child
-            break
-
     if dados_gerais is None:
-        st.warning(f"Não encontrei DADOS-GERAIS em {file_obj.name}.")
+        avisos.append(("warning", f"Não encontrei DADOS-GERAIS em {nome_arquivo}."))
         nome_completo = ""
         nome_citacoes = ""
         nacionalidade = ""
@@ -99,12 +181,12 @@ def parse_curriculo(file_obj):
         cidade_nasc = ""
         sexo = ""
     else:
-        nome_completo = dados_gerais.attrib.get("NOME-COMPLETO", "")
-        nome_citacoes = dados_gerais.attrib.get("NOME-EM-CITACOES-BIBLIOGRAFICAS", "")
-        nacionalidade = dados_gerais.attrib.get("NACIONALIDADE", "")
-        pais_nasc = dados_gerais.attrib.get("PAIS-DE-NASCIMENTO", "")
-        cidade_nasc = dados_gerais.attrib.get("CIDADE-NASCIMENTO", "")
-        sexo = dados_gerais.attrib.get("SEXO", "")
+        nome_completo = dados_gerais.get("NOME-COMPLETO", "")
+        nome_citacoes = dados_gerais.get("NOME-EM-CITACOES-BIBLIOGRAFICAS", "")
+        nacionalidade = dados_gerais.get("NACIONALIDADE", "")
+        pais_nasc = dados_gerais.get("PAIS-DE-NASCIMENTO", "")
+        cidade_nasc = dados_gerais.get("CIDADE-NASCIMENTO", "")
+        sexo = dados_gerais.get("SEXO", "")
 
     resumo = {
         "ID Lattes": id_lattes,
@@ -114,68 +196,103 @@ def parse_curriculo(file_obj):
         "País de nascimento": pais_nasc,
         "Cidade de nascimento": cidade_nasc,
         "Sexo": sexo,
-        "Arquivo": file_obj.name,
+        "Arquivo": nome_arquivo,
     }
 
-    return root, resumo
+    return xml_bytes, resumo, avisos
 
 
-def extrair_formacao(cv_root):
+def _localizar_formacao(xml_bytes: bytes, recover: bool):
+    """
+    Encontra FORMACAO-ACADEMICA-TITULACAO (com ou sem namespace), parando
+    a leitura assim que o elemento termina. Retorna o elemento ou None.
+    """
+    dentro_formacao = False
+    for event, elem in _iterparse_xml(xml_bytes, events=("start", "end"), recover=recover):
+        if _local(elem.tag) == "FORMACAO-ACADEMICA-TITULACAO":
+            if event == "end":
+                return elem
+            dentro_formacao = True
+        elif event == "end" and not dentro_formacao:
+            # Elementos fora da formação não serão consultados: liberar memória
+            elem.clear()
+    return None
+
+
+def extrair_formacao(xml_bytes):
     """
-    Extrai a formação acadêmica a partir do elemento raiz do currículo.
+    Extrai a formação acadêmica a partir dos bytes do currículo.
     Retorna lista de dicionários com registros de formação.
     """
-    if cv_root is None:
+    if xml_bytes is None:
         return []
 
-    # Encontrar FORMACAO-ACADEMICA-TITULACAO (com ou sem namespace)
-    formacao = None
-    for child in cv_root:
-        if child.tag.endswith("FORMACAO-ACADEMICA-TITULACAO"):
-            formacao = child
-            break
+    # O resumo só valida o XML até DADOS-GERAIS; se houver erro mais adiante,
+    # limpamos e tentamos de novo em modo tolerante
+    try:
+        try:
+            formacao = _localizar_formacao(xml_bytes, recover=False)
+        except ET.XMLSyntaxError:
+            xml_limpo = limpar_xml_bruto(xml_bytes)
+            formacao = _localizar_formacao(xml_limpo, recover=True)
+    except ET.XMLSyntaxError:
+        return []
 
     if formacao is None:
         return []
 
-    niveis = [
-        "GRADUACAO",
-        "ESPECIALIZACAO",
-        "MESTRADO",
-        "MESTRADO-PROFISSIONALIZANTE",
-        "DOUTORADO",
-        "POS-DOUTORADO",
-        "LIVRE-DOCENCIA",
-        "RESIDENCIA-MEDICA",
-        "APERFEICOAMENTO",
-        "CURSO-TECNICO-PROFISSIONALIZANTE",
-        "ENSINO-FUNDAMENTAL-PRIMEIRO-GRAU",
-        "ENSINO-MEDIO-SEGUNDO-GRAU",
-    ]
-
     registros_formacao = []
 
-    for nivel in niveis:
-        # formacao.findall pode falhar com namespace, então percorremos filhos e filtramos por sufixo
-        for elem in formacao:
-            if not elem.tag.endswith(nivel):
-                continue
-
-            registro = {
-                "Nível": nivel,
-                "Nome do curso": elem.attrib.get("NOME-CURSO", ""),
-                "Instituição": elem.attrib.get("NOME-INSTITUICAO", ""),
-                "Status do curso": elem.attrib.get("STATUS-DO-CURSO", ""),
-                "Ano início": elem.attrib.get("ANO-DE-INICIO", ""),
-                "Ano conclusão": elem.attrib.get("ANO-DE-CONCLUSAO", ""),
-                "Possui bolsa": elem.attrib.get("FLAG-BOLSA", ""),
-                "Agência de fomento": elem.attrib.get("NOME-AGENCIA", ""),
-            }
-            registros_formacao.append(registro)
+    # Uma única passada pelos filhos que são níveis de formação (XPath pré-compilado)
+    for elem in _NIVEIS_XP(formacao):
+        nivel = _local(elem.tag)
+        attrib = elem.attrib
+        registro = {
+            "Nível": nivel,
+            "Nome do curso": attrib.get("NOME-CURSO", ""),
+            "Instituição": attrib.get("NOME-INSTITUICAO", ""),
+            "Status do curso": attrib.get("STATUS-DO-CURSO", ""),
+            "Ano início": attrib.get("ANO-DE-INICIO", ""),
+            "Ano conclusão": attrib.get("ANO-DE-CONCLUSAO", ""),
+            "Possui bolsa": attrib.get("FLAG-BOLSA", ""),
+            "Agência de fomento": attrib.get("NOME-AGENCIA", ""),
+        }
+        registros_formacao.append(registro)
+
+    # Manter a saída agrupada na ordem de _NIVEIS (sort estável preserva a ordem do XML)
+    registros_formacao.sort(key=lambda r: _NIVEIS_ORDER[r["Nível"]])
 
     return registros_formacao
 
 
+@st.cache_data(show_spinner=False)
+def formacao_df(xml_bytes: bytes) -> pd.DataFrame:
+    """
+    Monta o DataFrame de formação acadêmica de um currículo.
+    Fica em cache pelos bytes do XML: ao voltar a um currículo já visto
+    não é preciso parsear o XML de novo.
+    """
+    return pd.DataFrame(extrair_formacao(xml_bytes)).astype("string[pyarrow]")
+
+
+@st.cache_data(show_spinner=False)
+def resumo_para_csv(df_resumo: pd.DataFrame) -> bytes:
+    """
+    Gera o CSV do resumo (UTF-8 com BOM, para abrir corretamente no Excel).
+    Fica em cache pelo conteúdo do DataFrame, evitando regerar a cada rerun.
+    """
+    return df_resumo.to_csv(index=False).encode("utf-8-sig")
+
+
+def impressao_upload(uploaded_file) -> tuple:
+    """
+    Identificação barata de um arquivo enviado: (nome, tamanho, SHA-1 dos
+    primeiros 4 KB), sem copiar o conteúdo inteiro.
+    """
+    inicio = uploaded_file.getbuffer()[:4096]
+    return uploaded_file.name, uploaded_file.size, hashlib.sha1(inicio).hexdigest()
+
+
 # ---------------------------------------------------------
 # INTERFACE PRINCIPAL
 # ---------------------------------------------------------
@@ -186,35 +303,70 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True,
 )
 
-parsed_cvs = {}  # key: ID Lattes (ou nome do arquivo), value: root Element
-rows_resumo = []
+parsed_cvs = []  # bytes do XML de cada currículo, na mesma ordem das linhas do resumo
+# Resumo acumulado por coluna (uma lista por campo), na ordem de exibição
+colunas_resumo = {
+    col: []
+    for col in (
+        "ID Lattes",
+        "Nome completo",
+        "Nome em citações",
+        "Nacionalidade",
+        "País de nascimento",
+        "Cidade de nascimento",
+        "Sexo",
+        "Arquivo",
+    )
+}
 
 if uploaded_files:
     st.success(f"{len(uploaded_files)} arquivo(s) carregado(s). Processando...")
 
-    for uf in uploaded_files:
-        # Garantir que o ponteiro está no início
-        uf.seek(0)
-        root, resumo = parse_curriculo(uf)
-        if root is not None and resumo is not None:
-            # Se não tiver ID Lattes, usamos nome do arquivo como chave
-            key_id = resumo["ID Lattes"] or uf.name
-            parsed_cvs[key_id] = root
-            rows_resumo.append(resumo)
+    # Resultados dos arquivos já processados nesta sessão, por impressão do upload:
+    # em reruns, arquivos já vistos não são lidos nem parseados de novo
+    if "cvs_processados" not in st.session_state:
+        st.session_state.cvs_processados = {}
+    cvs_processados = st.session_state.cvs_processados
+
+    impressoes = [impressao_upload(uf) for uf in uploaded_files]
+    novos = [(imp, uf) for imp, uf in zip(impressoes, uploaded_files) if imp not in cvs_processados]
+
+    if novos:
+        # Os bytes são lidos na thread principal; o parse (C do libxml2) roda em paralelo
+        nomes = [uf.name for _, uf in novos]
+        conteudos = [uf.getvalue() for _, uf in novos]
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            resultados = executor.map(parse_curriculo, nomes, conteudos)
+            for (imp, _), resultado in zip(novos, resultados):
+                cvs_processados[imp] = resultado
+
+    # Esquecer arquivos que foram removidos do uploader
+    for imp in cvs_processados.keys() - set(impressoes):
+        del cvs_processados[imp]
 
-    if rows_resumo:
-        df_resumo = pd.DataFrame(rows_resumo)
+    for imp in impressoes:
+        xml_bytes, resumo, avisos = cvs_processados[imp]
+
+        # Mensagens só podem ser emitidas na thread do script
+        for nivel, mensagem in avisos:
+            getattr(st, nivel)(mensagem)
+
+        if xml_bytes is not None and resumo is not None:
+            parsed_cvs.append(xml_bytes)
+            for col, valores in colunas_resumo.items():
+                valores.append(resumo[col])
+
+    if colunas_resumo["Arquivo"]:
+        # Colunas de texto em Arrow: menos custo para serializar até o navegador
+        df_resumo = pd.DataFrame(colunas_resumo, copy=False).astype("string[pyarrow]")
 
         st.subheader("📊 Resumo dos Currículos")
-        st.dataframe(df_resumo, use_container_width=True)
+        st.dataframe(df_resumo, use_container_width=True, hide_index=True)
 
         # Download do resumo em CSV
-        csv_buffer = BytesIO()
-        df_resumo.to_csv(csv_buffer, index=False, encoding="utf-8-sig")
-        csv_buffer.seek(0)
         st.download_button(
             label="⬇️ Baixar resumo em CSV",
-            data=csv_buffer,
+            data=resumo_para_csv(df_resumo),
             file_name="resumo_lattes.csv",
             mime="text/csv",
         )
@@ -222,32 +374,29 @@ if uploaded_files:
         st.markdown("---")
         st.subheader("🔍 Detalhar formação acadêmica de um currículo")
 
-        # Criar labels amigáveis para seleção
-        labels = []
-        ids = []
-        for _, row in df_resumo.iterrows():
-            rid = row["ID Lattes"] or row["Arquivo"]
-            label = f"{row['Nome completo'] or '[Sem nome]'} ({rid})"
-            labels.append(label)
-            ids.append(rid)
-
-        id_by_label = dict(zip(labels, ids))
+        # Criar labels amigáveis para seleção (sem ID Lattes, usamos o nome do arquivo)
+        nomes = df_resumo["Nome completo"].tolist()
+        ids = [
+            id_lattes or arquivo
+            for id_lattes, arquivo in zip(df_resumo["ID Lattes"].tolist(), df_resumo["Arquivo"].tolist())
+        ]
+        labels = [f"{nome or '[Sem nome]'} ({rid})" for nome, rid in zip(nomes, ids)]
 
-        selected_label = st.selectbox(
+        # A opção é a posição da linha: labels repetidos (mesmo nome e ID) não se confundem
+        selected_idx = st.selectbox(
             "Selecione um currículo para detalhar:",
-            options=labels,
+            options=range(len(labels)),
+            format_func=lambda i: labels[i],
         )
 
-        if selected_label:
-            selected_id = id_by_label[selected_label]
-            cv_root = parsed_cvs.get(selected_id)
+        if selected_idx is not None:
+            cv_xml = parsed_cvs[selected_idx]
 
-            registros_formacao = extrair_formacao(cv_root)
+            df_formacao = formacao_df(cv_xml)
 
-            if registros_formacao:
-                df_formacao = pd.DataFrame(registros_formacao)
+            if not df_formacao.empty:
                 st.markdown("#### 🎓 Formação acadêmica")
-                st.dataframe(df_formacao, use_container_width=True)
+                st.dataframe(df_formacao, use_container_width=True, hide_index=True)
             else:
                 st.info("Nenhuma informação de formação acadêmica encontrada para este currículo.")
 
@@ -256,4 +405,5 @@ if uploaded_files:
             "Baseado na estrutura do Currículo Lattes (XML) conforme schema oficial do Lattes Extrator (CNPq)."
         )
 else:
+    st.session_state.pop("cvs_processados", None)
     st.info("Envie pelo menos um arquivo XML de Currículo Lattes para começar.")